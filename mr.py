@@ -1,16 +1,32 @@
 import os
-import json
+import re
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-import threading
+import atexit
+import hashlib
 import time
+import logging
+import datetime
+from functools import lru_cache
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from cachetools import TTLCache
 from flask import Flask, request, jsonify
 import google.generativeai as genai
+from google.generativeai import caching
 from dotenv import load_dotenv
 
 # 환경 변수 로드
 load_dotenv()
 
+# 로깅 설정
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+log = logging.getLogger(__name__)
+
 # 필요한 API 키와 설정 가져오기
 GITLAB_TOKEN = os.getenv("GITLAB_TOKEN")
 GITLAB_URL = os.getenv("GITLAB_URL", "https://gitlab.com")  # 기본값 설정
@@ -19,6 +35,9 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 # Gemini API 설정
 genai.configure(api_key=GEMINI_API_KEY)
 
+# Gemini 모델 (요청마다 새로 만들지 않고 재사용)
+GEMINI_MODEL = genai.GenerativeModel("gemini-2.0-flash")
+
 # Flask 앱 초기화
 app = Flask(__name__)
 
@@ -28,32 +47,185 @@ GITLAB_HEADERS = {"Private-Token": GITLAB_TOKEN, "Content-Type": "application/js
 # 요청 타임아웃 설정 (초)
 REQUEST_TIMEOUT = 10
 
+# GitLab 세션 (keep-alive로 TCP/TLS 연결 재사용)
+SESSION = requests.Session()
+SESSION.headers.update(GITLAB_HEADERS)
+SESSION.headers["Connection"] = "keep-alive"
+SESSION.mount(
+    GITLAB_URL,
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]
+        ),
+    ),
+)
+
+# MR 변경 사항 캐시 (같은 MR에 대한 반복 요청 시 GitLab 호출 생략)
+_MR_CHANGES_CACHE = TTLCache(maxsize=512, ttl=120)
+_MR_CACHE_LOCK = Lock()
+
+# MR 전역 ID -> IID 매핑 캐시 (IID는 바뀌지 않으므로 길게 유지)
+_MR_IID_CACHE = TTLCache(maxsize=2048, ttl=3600)
+
+# Gemini 응답 캐시 (동일한 프롬프트에 대해 재호출하지 않음)
+_GEMINI_CACHE = TTLCache(maxsize=256, ttl=3600)
+_GEMINI_CACHE_LOCK = Lock()
+
+# Gemini 컨텍스트 캐시 (같은 MR에 대한 반복 댓글 요청 시 MR 내용 부분을 서버에 캐시)
+# 컨텍스트 캐시는 고정 버전 모델이 필요하고, 너무 짧은 프롬프트는 캐시할 수 없음
+GEMINI_CACHE_MODEL = "models/gemini-2.0-flash-001"
+GEMINI_CONTEXT_TTL = 600
+MIN_CONTEXT_CACHE_CHARS = 16000
+# 서버 쪽 캐시가 만료되기 전에 로컬 항목이 먼저 만료되도록 TTL을 조금 짧게 설정
+# 값은 (CachedContent, GenerativeModel) 튜플, 캐시 생성에 실패한 키는 _CONTEXT_CACHE_FAILED
+_GEMINI_CONTEXT_CACHE = TTLCache(maxsize=128, ttl=GEMINI_CONTEXT_TTL - 60)
+_CONTEXT_CACHE_FAILED = (None, None)
+
+# 리뷰 대상 코드 파일 확장자
+CODE_EXTENSIONS = frozenset(
+    {
+        ".py",
+        ".js",
+        ".java",
+        ".cpp",
+        ".c",
+        ".h",
+        ".cs",
+        ".go",
+        ".rb",
+        ".php",
+        ".ts",
+        ".kt",
+        ".swift",
+    }
+)
+
+# Gemini 프롬프트에 넣을 diff 크기 제한 (문자 수) 및 최대 파일 수
+MAX_DIFF_PER_FILE = 8192
+MAX_TOTAL_DIFF = 65536
+MAX_FILES = 50
+
+# 최근 접수한 웹훅 (GitLab 재전송으로 인한 중복 처리 방지)
+_SEEN = TTLCache(maxsize=10000, ttl=600)
+_SEEN_LOCK = Lock()
+
+# 웹훅 백그라운드 처리용 스레드 풀 (요청마다 스레드를 만들지 않고 재사용)
+WEBHOOK_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WEBHOOK_WORKERS", "8")), thread_name_prefix="mrbot"
+)
+atexit.register(WEBHOOK_POOL.shutdown, wait=False)
+
+# 댓글 트리거 (명령어 트리거가 우선이며, 명령어끼리는 나열된 순서대로 우선)
+COMMAND_RES = tuple(
+    re.compile(re.escape(trigger), re.IGNORECASE)
+    for trigger in ("@bot", "/review", "/analyze")
+)
+SIMPLE_RE = re.compile(r"코드\s*리뷰|리뷰")
+
 # 봇 식별을 위한 특별한 문자열 (댓글에 자동으로 추가됨)
 BOT_SIGNATURE = "🤖 AI 코드 리뷰"
 
 
-def get_mr_changes(project_id, mr_iid):
+@lru_cache(maxsize=1024)
+def _project_base(project_id):
+    """
+    프로젝트 API 기본 URL.
+
+    Args:
+        project_id: GitLab 프로젝트 ID
+
+    Returns:
+        프로젝트 API 기본 URL
+    """
+    return f"{GITLAB_URL}/api/v4/projects/{project_id}"
+
+
+@lru_cache(maxsize=4096)
+def _mr_base(project_id, mr_iid):
+    """
+    MR API 기본 URL.
+
+    Args:
+        project_id: GitLab 프로젝트 ID
+        mr_iid: MR의 내부 ID
+
+    Returns:
+        MR API 기본 URL
+    """
+    return f"{_project_base(project_id)}/merge_requests/{mr_iid}"
+
+
+@lru_cache(maxsize=4096)
+def _quote_path(file_path):
+    """
+    파일 경로를 URL 경로 한 칸에 들어가도록 인코딩.
+
+    Args:
+        file_path: 파일 경로
+
+    Returns:
+        '/'까지 인코딩된 파일 경로
+    """
+    return quote(file_path, safe="")
+
+
+def invalidate_mr_cache(project_id, mr_iid):
+    """
+    특정 MR에 대한 캐시 항목 제거.
+
+    Args:
+        project_id: GitLab 프로젝트 ID
+        mr_iid: MR의 내부 ID
+    """
+    with _MR_CACHE_LOCK:
+        for key in [
+            k for k in _MR_CHANGES_CACHE.keys() if k[:2] == (project_id, mr_iid)
+        ]:
+            _MR_CHANGES_CACHE.pop(key, None)
+
+    with _GEMINI_CACHE_LOCK:
+        context_keys = [
+            k for k in _GEMINI_CONTEXT_CACHE.keys() if k[:2] == (project_id, mr_iid)
+        ]
+    for key in context_keys:
+        _drop_context_cache(key)
+
+
+def get_mr_changes(project_id, mr_iid, sha=None):
     """
     GitLab API를 사용하여 MR의 변경 사항을 가져옴.
 
     Args:
         project_id: GitLab 프로젝트 ID
         mr_iid: MR의 내부 ID
+        sha: MR의 최신 커밋 SHA (캐시 키에 사용, 선택적)
 
     Returns:
         변경된 파일 목록과 각 파일의 diff 정보
     """
-    url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/changes"
+    cache_key = (project_id, mr_iid, sha)
+    with _MR_CACHE_LOCK:
+        cached = _MR_CHANGES_CACHE.get(cache_key)
+    if cached is not None:
+        print(f"MR 변경 사항 캐시 사용: project_id={project_id}, mr_iid={mr_iid}")
+        return cached
+
+    url = f"{_mr_base(project_id, mr_iid)}/changes"
 
     try:
         # 타임아웃 설정 추가
-        response = requests.get(url, headers=GITLAB_HEADERS, timeout=REQUEST_TIMEOUT)
+        response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
 
         if response.status_code != 200:
             print(f"GitLab API 호출 실패: {response.status_code} - {response.text}")
             return None
 
-        return response.json()
+        changes_data = response.json()
+        with _MR_CACHE_LOCK:
+            _MR_CHANGES_CACHE[cache_key] = changes_data
+        return changes_data
     except requests.exceptions.Timeout:
         print(f"GitLab API 요청 타임아웃: project_id={project_id}, mr_iid={mr_iid}")
         return None
@@ -62,7 +234,51 @@ def get_mr_changes(project_id, mr_iid):
         return None
 
 
-def get_file_content(project_id, commit_sha, file_path):
+def get_mr_iid_by_id(mr_id):
+    """
+    MR 전역 ID로 IID 조회 (GraphQL로 해당 MR만 직접 조회).
+
+    Args:
+        mr_id: MR의 전역 ID (웹훅의 noteable_id)
+
+    Returns:
+        MR의 내부 ID, 찾지 못하면 None
+    """
+    with _MR_CACHE_LOCK:
+        cached = _MR_IID_CACHE.get(mr_id)
+    if cached is not None:
+        return cached
+
+    url = f"{GITLAB_URL}/api/graphql"
+    query = "query($id: MergeRequestID!) { mergeRequest(id: $id) { iid } }"
+    variables = {"id": f"gid://gitlab/MergeRequest/{mr_id}"}
+
+    try:
+        response = SESSION.post(
+            url,
+            json={"query": query, "variables": variables},
+            timeout=REQUEST_TIMEOUT,
+        )
+
+        if response.status_code != 200:
+            print(f"MR IID 조회 실패: {response.status_code} - {response.text}")
+            return None
+
+        mr = (response.json().get("data") or {}).get("mergeRequest")
+        if not mr:
+            print(f"MR IID 조회 실패: mr_id={mr_id}")
+            return None
+
+        mr_iid = int(mr["iid"])
+        with _MR_CACHE_LOCK:
+            _MR_IID_CACHE[mr_id] = mr_iid
+        return mr_iid
+    except Exception as e:
+        print(f"MR IID 조회 실패: {str(e)}")
+        return None
+
+
+def get_file_content(project_id, commit_sha, file_path, max_bytes=None):
     """
     특정 커밋 파일 내용 가져오기.
 
@@ -70,23 +286,40 @@ def get_file_content(project_id, commit_sha, file_path):
         project_id: GitLab 프로젝트 ID
         commit_sha: 파일을 가져올 커밋의 SHA
         file_path: 파일 경로
+        max_bytes: 읽을 최대 바이트 수 (선택적, 없으면 전체)
 
     Returns:
         파일 내용 (디코딩된 텍스트)
     """
-    url = f"{GITLAB_URL}/api/v4/projects/{project_id}/repository/files/{requests.utils.quote(file_path, safe='')}/raw"
+    url = f"{_project_base(project_id)}/repository/files/{_quote_path(file_path)}/raw"
     params = {"ref": commit_sha}
 
     try:
-        response = requests.get(
-            url, headers=GITLAB_HEADERS, params=params, timeout=REQUEST_TIMEOUT
-        )
-
-        if response.status_code != 200:
-            print(f"파일 내용 가져오기 실패: {response.status_code} - {response.text}")
-            return None
-
-        return response.text
+        with SESSION.get(
+            url, params=params, timeout=REQUEST_TIMEOUT, stream=max_bytes is not None
+        ) as response:
+            if response.status_code != 200:
+                print(
+                    f"파일 내용 가져오기 실패: {response.status_code} - {response.text}"
+                )
+                return None
+
+            if max_bytes is None:
+                content = response.content
+            else:
+                # 큰 파일은 필요한 만큼만 받고 중단
+                # (다 읽지 않은 연결은 풀로 돌아가지 않고 닫힘)
+                chunks = []
+                total = 0
+                for chunk in response.iter_content(8192):
+                    chunks.append(chunk)
+                    total += len(chunk)
+                    if total >= max_bytes:
+                        break
+                content = b"".join(chunks)[:max_bytes]
+
+        # response.text의 문자셋 추측을 건너뛰고 바로 디코딩
+        return content.decode("utf-8", "replace")
     except requests.exceptions.Timeout:
         print(f"파일 내용 가져오기 타임아웃: {file_path}")
         return None
@@ -95,76 +328,233 @@ def get_file_content(project_id, commit_sha, file_path):
         return None
 
 
-def analyze_with_gemini(changes_data, mr_info, user_prompt=None):
+def _code_changes(changes):
     """
-    잼민이야 해줘.
+    변경 사항 중 코드 파일만 걸러내는 제너레이터.
+
+    Args:
+        changes: MR의 변경 사항 목록
+
+    Yields:
+        확장자가 CODE_EXTENSIONS에 포함된 변경 사항
+    """
+    for change in changes:
+        file_path = change.get("new_path") or change.get("old_path") or ""
+        if os.path.splitext(file_path)[1].lower() in CODE_EXTENSIONS:
+            yield change
+
+
+def _trim_diff(diff):
+    """
+    프롬프트에 넣기 위해 큰 diff 줄이기.
+
+    Args:
+        diff: 파일의 diff 문자열
+
+    Returns:
+        MAX_DIFF_PER_FILE 이하로 줄인 diff
+    """
+    if len(diff) <= MAX_DIFF_PER_FILE:
+        return diff
+
+    # 큰 diff는 컨텍스트 줄을 버리고 변경된 줄과 hunk 헤더만 남김
+    diff = "\n".join(
+        line for line in diff.splitlines() if line.startswith(("+", "-", "@@"))
+    )
+    if len(diff) > MAX_DIFF_PER_FILE:
+        diff = diff[:MAX_DIFF_PER_FILE] + "\n...(이하 생략)..."
+    return diff
+
+
+def _build_prompt(changes_data, mr_info, user_prompt, header, footer):
+    """
+    Gemini에 보낼 프롬프트 구성.
+
+    MR 전체에 공통인 앞부분(요청 문장, MR 정보, diff)과 요청마다 달라지는
+    뒷부분(사용자 요청, 분석 지시)을 나눠서 반환함. 앞부분은 컨텍스트 캐시에 사용됨.
 
     Args:
         changes_data: MR의 변경 사항 데이터
         mr_info: MR에 대한 기본 정보
         user_prompt: 사용자가 추가한 프롬프트 (선택적)
+        header: 프롬프트 맨 앞의 요청 문장
+        footer: 프롬프트 맨 끝의 분석 지시 문장
 
     Returns:
-        Gemini API의 코드 리뷰 분석 결과
+        (앞부분, 뒷부분) 프롬프트 문자열 튜플
     """
-    start_time = time.time()
-    model = genai.GenerativeModel("gemini-2.0-flash")
-
-    # 프롬프트 구성
-    prompt = f"""
-    다음 GitLab Merge Request의 코드 변경 사항을 시니어 개발자가 해준다는 느낌으로 분석하고 리뷰해주세요:
+    # 프롬프트 구성 (문자열 반복 연결 대신 리스트에 모아 한 번에 join)
+    parts = [
+        f"""
+    {header}
     
     MR 제목: {mr_info.get('title', '제목 없음')}
     MR 설명: {mr_info.get('description', '설명 없음')}
     """
+    ]
+
+    parts.append(
+        """
+    변경된 파일:
+    """
+    )
+
+    # 변경된 각 코드 파일에 대한 정보 추가 (작은 diff부터 넣어 최대한 많은 파일 포함)
+    changes = sorted(
+        _code_changes(changes_data.get("changes", [])),
+        key=lambda c: len(c.get("diff") or ""),
+    )
+    total_diff = 0
+    for i, change in enumerate(changes):
+        if i >= MAX_FILES:
+            print(f"파일 수 제한({MAX_FILES}개) 초과, 이후 파일 생략")
+            break
+
+        file_path = change.get("new_path", change.get("old_path", "알 수 없는 파일"))
+        diff = _trim_diff(change.get("diff") or "변경사항 없음")
+        total_diff += len(diff)
+        if total_diff > MAX_TOTAL_DIFF:
+            print(f"diff 총량 제한({MAX_TOTAL_DIFF}자) 초과, 이후 파일 생략")
+            break
+
+        parts.append(f"\n\n파일: {file_path}\n변경사항:\n{diff}\n")
+
+    prefix = "".join(parts)
 
     # 사용자 요청 프롬프트가 있는 경우 추가
+    suffix = footer
     if user_prompt:
-        prompt += f"""
+        suffix = (
+            f"""
     사용자 요청: {user_prompt}
     """
+            + footer
+        )
 
-    prompt += """
-    변경된 파일:
+    return prefix, suffix
+
+
+def _drop_context_cache(context_key):
     """
+    컨텍스트 캐시 항목을 제거하고 서버 쪽 CachedContent도 삭제.
 
-    # 변경된 각 파일에 대한 정보 추가
-    for change in changes_data.get("changes", []):
-        file_path = change.get("new_path", change.get("old_path", "알 수 없는 파일"))
+    Args:
+        context_key: (project_id, mr_iid, head_sha) 캐시 키
+    """
+    with _GEMINI_CACHE_LOCK:
+        entry = _GEMINI_CONTEXT_CACHE.pop(context_key, None)
+    if entry is None:
+        return
 
-        # 파일 확장자 확인 (코드 파일만 분석)
-        code_extensions = [
-            ".py",
-            ".js",
-            ".java",
-            ".cpp",
-            ".c",
-            ".h",
-            ".cs",
-            ".go",
-            ".rb",
-            ".php",
-            ".ts",
-            ".kt",
-            ".swift",
-        ]
-        file_ext = os.path.splitext(file_path)[1].lower()
+    cached_content, _ = entry
+    if cached_content is None:
+        return
 
-        if file_ext not in code_extensions:
-            continue
+    try:
+        cached_content.delete()
+    except Exception as e:
+        print(f"Gemini 컨텍스트 캐시 삭제 실패: {str(e)}")
 
-        prompt += f"\n\n파일: {file_path}\n"
-        prompt += f"변경사항:\n{change.get('diff', '변경사항 없음')}\n"
 
-    prompt += """
-    위 코드 변경사항에 대하여
-    코드 품질, 잠재적 문제점, 성능 고려사항, 개선 제안
-    을 간략하게 대략 500 ~ 700자 안으로 구체적인 코드 부분과 함께 분석해주세요.
+def _get_context_model(context_key, prefix):
+    """
+    MR 공통 프롬프트를 서버에 캐시한 모델 가져오기.
+
+    Args:
+        context_key: (project_id, mr_iid, head_sha) 캐시 키
+        prefix: 캐시할 MR 공통 프롬프트
+
+    Returns:
+        캐시된 컨텍스트를 사용하는 모델, 캐시를 쓸 수 없으면 None
+    """
+    if context_key is None or len(prefix) < MIN_CONTEXT_CACHE_CHARS:
+        return None
+
+    with _GEMINI_CACHE_LOCK:
+        entry = _GEMINI_CONTEXT_CACHE.get(context_key)
+    if entry is _CONTEXT_CACHE_FAILED:
+        # 이전에 캐시 생성이 실패한 MR (최소 토큰 수 미달 등)은 다시 시도하지 않음
+        return None
+    if entry is not None:
+        print(f"Gemini 컨텍스트 캐시 사용: {context_key}")
+        return entry[1]
+
+    cached_content = None
+    try:
+        cached_content = caching.CachedContent.create(
+            model=GEMINI_CACHE_MODEL,
+            contents=[prefix],
+            ttl=datetime.timedelta(seconds=GEMINI_CONTEXT_TTL),
+        )
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content=cached_content
+        )
+    except Exception as e:
+        print(f"Gemini 컨텍스트 캐시 생성 실패: {str(e)}")
+        if cached_content is not None:
+            try:
+                cached_content.delete()
+            except Exception as delete_error:
+                print(f"Gemini 컨텍스트 캐시 삭제 실패: {str(delete_error)}")
+        with _GEMINI_CACHE_LOCK:
+            _GEMINI_CONTEXT_CACHE.setdefault(context_key, _CONTEXT_CACHE_FAILED)
+        return None
+
+    # 같은 MR에 대한 다른 요청이 먼저 캐시를 만들었으면 그쪽을 쓰고 새로 만든 캐시는 삭제
+    with _GEMINI_CACHE_LOCK:
+        existing = _GEMINI_CONTEXT_CACHE.get(context_key)
+        if existing is None or existing is _CONTEXT_CACHE_FAILED:
+            _GEMINI_CONTEXT_CACHE[context_key] = (cached_content, model)
+            existing = None
+
+    if existing is not None:
+        try:
+            cached_content.delete()
+        except Exception as e:
+            print(f"Gemini 컨텍스트 캐시 삭제 실패: {str(e)}")
+        return existing[1]
+    return model
+
+
+def _run_gemini(prefix, suffix, context_key=None):
     """
+    Gemini API 호출 (동일한 프롬프트는 캐시된 응답 사용).
+
+    Args:
+        prefix: MR 공통 프롬프트
+        suffix: 요청마다 달라지는 프롬프트
+        context_key: 컨텍스트 캐시 키 (선택적, 없으면 컨텍스트 캐시 미사용)
+
+    Returns:
+        Gemini API의 응답 텍스트
+    """
+    start_time = time.time()
+    prompt = prefix + suffix
+
+    cache_key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    with _GEMINI_CACHE_LOCK:
+        cached = _GEMINI_CACHE.get(cache_key)
+    if cached is not None:
+        print("Gemini 응답 캐시 사용")
+        return cached
 
     try:
-        response = model.generate_content(prompt)
+        model = _get_context_model(context_key, prefix)
+        response = None
+        if model is not None:
+            try:
+                response = model.generate_content(suffix)
+            except Exception as e:
+                # 서버 캐시가 만료/삭제된 경우 등: 캐시를 버리고 전체 프롬프트로 재시도
+                print(
+                    f"Gemini 컨텍스트 캐시 호출 실패, 전체 프롬프트로 재시도: {str(e)}"
+                )
+                _drop_context_cache(context_key)
+        if response is None:
+            response = GEMINI_MODEL.generate_content(prompt)
         print(f"Gemini API 분석 소요 시간: {time.time() - start_time:.2f}초")
+        with _GEMINI_CACHE_LOCK:
+            _GEMINI_CACHE[cache_key] = response.text
         return response.text
     except Exception as e:
         print(f"Gemini API 호출 실패: {str(e)}")
@@ -172,9 +562,9 @@ def analyze_with_gemini(changes_data, mr_info, user_prompt=None):
         return f"코드 분석 중 오류가 발생했습니다: {str(e)}"
 
 
-def analyze_with_gemini_for_comment(changes_data, mr_info, user_prompt=None):
+def analyze_with_gemini(changes_data, mr_info, user_prompt=None):
     """
-    댓글용으로 수정된 프롬프트.
+    잼민이야 해줘.
 
     Args:
         changes_data: MR의 변경 사항 데이터
@@ -184,68 +574,46 @@ def analyze_with_gemini_for_comment(changes_data, mr_info, user_prompt=None):
     Returns:
         Gemini API의 코드 리뷰 분석 결과
     """
-    start_time = time.time()
-    model = genai.GenerativeModel("gemini-2.0-flash")
-
-    # 프롬프트 구성
-    prompt = f"""
-    다음 GitLab Merge Request의 코드 변경 사항 중 제가 원하는 부분만 시니어 개발자가 해준다는 느낌으로 분석하고 리뷰해주세요:
-    
-    MR 제목: {mr_info.get('title', '제목 없음')}
-    MR 설명: {mr_info.get('description', '설명 없음')}
-    """
+    prefix, suffix = _build_prompt(
+        changes_data,
+        mr_info,
+        user_prompt,
+        header="다음 GitLab Merge Request의 코드 변경 사항을 시니어 개발자가 해준다는 느낌으로 분석하고 리뷰해주세요:",
+        footer="""
+    위 코드 변경사항에 대하여
+    코드 품질, 잠재적 문제점, 성능 고려사항, 개선 제안
+    을 간략하게 대략 500 ~ 700자 안으로 구체적인 코드 부분과 함께 분석해주세요.
+    """,
+    )
+    return _run_gemini(prefix, suffix)
 
-    # 사용자 요청 프롬프트가 있는 경우 추가
-    if user_prompt:
-        prompt += f"""
-    사용자 요청: {user_prompt}
-    """
 
-    prompt += """
-    변경된 파일:
+def analyze_with_gemini_for_comment(
+    changes_data, mr_info, user_prompt=None, context_key=None
+):
     """
+    댓글용으로 수정된 프롬프트.
 
-    # 변경된 각 파일에 대한 정보 추가
-    for change in changes_data.get("changes", []):
-        file_path = change.get("new_path", change.get("old_path", "알 수 없는 파일"))
-
-        # 파일 확장자 확인 (코드 파일만 분석)
-        code_extensions = [
-            ".py",
-            ".js",
-            ".java",
-            ".cpp",
-            ".c",
-            ".h",
-            ".cs",
-            ".go",
-            ".rb",
-            ".php",
-            ".ts",
-            ".kt",
-            ".swift",
-        ]
-        file_ext = os.path.splitext(file_path)[1].lower()
-
-        if file_ext not in code_extensions:
-            continue
-
-        prompt += f"\n\n파일: {file_path}\n"
-        prompt += f"변경사항:\n{change.get('diff', '변경사항 없음')}\n"
+    Args:
+        changes_data: MR의 변경 사항 데이터
+        mr_info: MR에 대한 기본 정보
+        user_prompt: 사용자가 추가한 프롬프트 (선택적)
+        context_key: (project_id, mr_iid, head_sha) 컨텍스트 캐시 키 (선택적)
 
-    prompt += """
+    Returns:
+        Gemini API의 코드 리뷰 분석 결과
+    """
+    prefix, suffix = _build_prompt(
+        changes_data,
+        mr_info,
+        user_prompt,
+        header="다음 GitLab Merge Request의 코드 변경 사항 중 제가 원하는 부분만 시니어 개발자가 해준다는 느낌으로 분석하고 리뷰해주세요:",
+        footer="""
     위 코드 변경사항에 제가 원하는 부분을을
     간략하게 대략 300자 안으로 분석해주세요.
-    """
-
-    try:
-        response = model.generate_content(prompt)
-        print(f"Gemini API 분석 소요 시간: {time.time() - start_time:.2f}초")
-        return response.text
-    except Exception as e:
-        print(f"Gemini API 호출 실패: {str(e)}")
-        print(f"Gemini API 분석 소요 시간 (실패): {time.time() - start_time:.2f}초")
-        return f"코드 분석 중 오류가 발생했습니다: {str(e)}"
+    """,
+    )
+    return _run_gemini(prefix, suffix, context_key)
 
 
 def post_comment_to_mr(project_id, mr_iid, comment):
@@ -260,36 +628,29 @@ def post_comment_to_mr(project_id, mr_iid, comment):
     Returns:
         성공 여부 (Boolean)
     """
-    url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}/notes"
+    url = f"{_mr_base(project_id, mr_iid)}/notes"
     data = {"body": comment}
 
-    # 디버깅을 위한 로깅 추가
-    print(f"댓글 작성 요청 URL: {url}")
-    print(f"요청 헤더: {GITLAB_HEADERS}")
-    print(f"요청 데이터 길이: {len(str(data))} 바이트")
+    # 디버깅을 위한 로깅 (토큰이 포함된 헤더는 출력하지 않음)
+    log.debug("댓글 작성 요청 URL: %s, 댓글 길이: %d", url, len(comment))
 
     try:
-        response = requests.post(
-            url, headers=GITLAB_HEADERS, json=data, timeout=REQUEST_TIMEOUT
-        )
+        response = SESSION.post(url, json=data, timeout=REQUEST_TIMEOUT)
 
-        # 응답 내용 상세 로깅
-        print(f"댓글 작성 응답 코드: {response.status_code}")
-        print(f"댓글 작성 응답 헤더: {response.headers}")
-        print(
-            f"댓글 작성 응답 내용: {response.text[:200]}..."
-        )  # 응답이 길 수 있어 일부만 출력
+        log.debug("댓글 작성 응답 코드: %s", response.status_code)
 
         if response.status_code not in [200, 201]:
-            print(f"댓글 작성 실패: {response.status_code} - {response.text}")
+            log.warning(
+                "댓글 작성 실패: %s - %s", response.status_code, response.text[:200]
+            )
             return False
 
         return True
     except requests.exceptions.Timeout:
-        print(f"댓글 작성 타임아웃: project_id={project_id}, mr_iid={mr_iid}")
+        log.warning("댓글 작성 타임아웃: project_id=%s, mr_iid=%s", project_id, mr_iid)
         return False
     except Exception as e:
-        print(f"댓글 작성 예외 발생: {str(e)}")
+        log.warning("댓글 작성 예외 발생: %s", e)
         return False
 
 
@@ -311,11 +672,17 @@ def process_mr_in_background(data):
     project_id = mr_attrs.get("target_project_id")
     mr_iid = mr_attrs.get("iid")
 
+    last_commit_sha = mr_attrs.get("last_commit", {}).get("id")
+
     print(f"백그라운드에서 MR 처리 시작: project_id={project_id}, mr_iid={mr_iid}")
 
+    # MR이 업데이트되면 이전 캐시는 더 이상 유효하지 않음
+    if action == "update":
+        invalidate_mr_cache(project_id, mr_iid)
+
     # MR 변경 사항 가져오기
     start_time = time.time()
-    changes_data = get_mr_changes(project_id, mr_iid)
+    changes_data = get_mr_changes(project_id, mr_iid, last_commit_sha)
     print(f"MR 변경 사항 가져오기 소요 시간: {time.time() - start_time:.2f}초")
 
     if not changes_data:
@@ -368,8 +735,8 @@ def process_note_in_background(data):
     noteable_id = note.get("noteable_id")
     mr_iid = None
 
-    # 웹훅 데이터 구조를 더 자세히 로깅
-    print(f"Note Hook 전체 데이터: {json.dumps(data)[:1000]}...")
+    # 웹훅 데이터 구조 로깅 (전체 내용은 웹훅 수신 시 미리보기로 출력됨)
+    print(f"Note Hook 데이터 키: {list(data.keys())}")
 
     # MR 정보를 다양한 위치에서 찾기 시도
     if noteable_type == "MergeRequest":
@@ -382,21 +749,8 @@ def process_note_in_background(data):
 
         # 방법 3: 다른 경로 시도
         if mr_iid is None:
-            try:
-                # MR ID를 사용하여 API로 IID 조회
-                url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests"
-                response = requests.get(
-                    url, headers=GITLAB_HEADERS, timeout=REQUEST_TIMEOUT
-                )
-
-                if response.status_code == 200:
-                    mrs = response.json()
-                    for mr in mrs:
-                        if mr.get("id") == noteable_id:
-                            mr_iid = mr.get("iid")
-                            break
-            except Exception as e:
-                print(f"MR IID 조회 실패: {str(e)}")
+            # MR ID를 사용하여 API로 IID 조회
+            mr_iid = get_mr_iid_by_id(noteable_id)
 
     print(
         f"노트 처리 시작: project_id={project_id}, noteable_type={noteable_type}, noteable_id={noteable_id}, mr_iid={mr_iid}, note_id={note_id}"
@@ -422,34 +776,29 @@ def process_note_in_background(data):
 
     # 사용자 프롬프트 추출
     user_prompt = None
-    command_triggers = ["@bot", "/review", "/analyze"]
-
-    for trigger in command_triggers:
-        if trigger in note_body.lower():
-            # 트리거 이후의 텍스트를 사용자 프롬프트로 추출
-            trigger_index = note_body.lower().find(trigger)
-            if trigger_index != -1:
-                # 트리거 다음 텍스트 추출 (트리거 길이 + 공백 고려)
-                user_prompt = note_body[trigger_index + len(trigger) :].strip()
-                print(f"사용자 프롬프트 추출: '{user_prompt}'")
-                break
-
-    # 더 간단한 트리거도 확인 (코드리뷰, 코드 리뷰, 리뷰)
-    simple_triggers = ["코드리뷰", "코드 리뷰", "리뷰"]
-    if user_prompt is None:
-        for trigger in simple_triggers:
-            if trigger in note_body.lower():
-                # 간단한 트리거가 있을 경우 전체 내용을 프롬프트로 사용
-                user_prompt = note_body.strip()
-                print(f"간단한 트리거로 프롬프트 추출: '{user_prompt}'")
-                break
+    match = next(
+        (m for m in (regex.search(note_body) for regex in COMMAND_RES) if m), None
+    )
+
+    if match:
+        # 트리거 이후의 텍스트를 사용자 프롬프트로 추출
+        user_prompt = note_body[match.end() :].strip()
+        print(f"사용자 프롬프트 추출: '{user_prompt}'")
+    elif SIMPLE_RE.search(note_body):
+        # 간단한 트리거가 있을 경우 전체 내용을 프롬프트로 사용
+        user_prompt = note_body.strip()
+        print(f"간단한 트리거로 프롬프트 추출: '{user_prompt}'")
 
     # 명령어가 감지되면 코드 리뷰 수행
     if user_prompt is not None:
         print(f"댓글에서 명령어 감지됨, 코드 리뷰 시작")
 
-        # MR 변경 사항 가져오기
-        changes_data = get_mr_changes(project_id, mr_iid)
+        last_commit_sha = (
+            data.get("merge_request", {}).get("last_commit", {}).get("id")
+        )
+
+        # MR 변경 사항 가져오기 (MR 제목/설명도 같은 응답에 포함됨)
+        changes_data = get_mr_changes(project_id, mr_iid, last_commit_sha)
 
         if not changes_data:
             print(f"MR {mr_iid} 변경 사항을 가져올 수 없습니다.")
@@ -457,26 +806,19 @@ def process_note_in_background(data):
             post_comment_to_mr(project_id, mr_iid, response)
             return
 
-        # MR 정보 가져오기 (별도 API 호출 필요)
-        try:
-            url = f"{GITLAB_URL}/api/v4/projects/{project_id}/merge_requests/{mr_iid}"
-            response = requests.get(
-                url, headers=GITLAB_HEADERS, timeout=REQUEST_TIMEOUT
-            )
-            mr_data = response.json() if response.status_code == 200 else {}
-
-            mr_info = {
-                "title": mr_data.get("title", "제목 없음"),
-                "description": mr_data.get("description", "설명 없음"),
-            }
-        except Exception as e:
-            print(f"MR 정보 가져오기 실패: {str(e)}")
-            mr_info = {"title": "제목 없음", "description": "설명 없음"}
+        # 변경 사항 API 응답에 MR 제목과 설명이 포함되어 있으므로 별도 호출 없이 재사용
+        mr_info = {
+            "title": changes_data.get("title", "제목 없음"),
+            "description": changes_data.get("description", "설명 없음"),
+        }
 
         # 코드 분석 수행 (사용자 프롬프트 추가)
         print(f"사용자 요청에 의한 코드 리뷰 시작: MR #{mr_iid}")
+        context_key = (
+            (project_id, mr_iid, last_commit_sha) if last_commit_sha else None
+        )
         analysis_result = analyze_with_gemini_for_comment(
-            changes_data, mr_info, user_prompt
+            changes_data, mr_info, user_prompt, context_key
         )
 
         # 분석 결과를 MR에 댓글로 작성
@@ -504,6 +846,60 @@ def process_note_in_background(data):
     )
 
 
+def _log_task_exception(future):
+    """
+    스레드 풀 작업에서 발생한 예외를 트레이스백과 함께 기록.
+
+    Args:
+        future: WEBHOOK_POOL.submit이 반환한 Future
+    """
+    if future.cancelled():
+        return
+
+    exc = future.exception()
+    if exc is not None:
+        log.error(
+            "백그라운드 처리 중 예외 발생",
+            exc_info=(type(exc), exc, exc.__traceback__),
+        )
+
+
+def _is_duplicate_delivery(event_uuid, data):
+    """
+    최근에 접수한 웹훅인지 확인하고, 처음 보는 웹훅이면 기록.
+
+    Args:
+        event_uuid: X-Gitlab-Event-UUID 헤더 값 (없을 수 있음)
+        data: GitLab 웹훅으로 받은 데이터
+
+    Returns:
+        이미 접수한 웹훅이면 True
+    """
+    attrs = data.get("object_attributes", {})
+    object_kind = data.get("object_kind")
+
+    # MR 업데이트와 댓글 수정은 같은 ID로 다시 오므로 액션과 수정 시각까지 키에 포함
+    keys = []
+    if attrs.get("id") is not None:
+        keys.append(
+            (
+                object_kind,
+                attrs.get("id"),
+                attrs.get("action"),
+                attrs.get("updated_at"),
+            )
+        )
+    if event_uuid:
+        keys.append(event_uuid)
+
+    with _SEEN_LOCK:
+        if any(key in _SEEN for key in keys):
+            return True
+        for key in keys:
+            _SEEN[key] = True
+    return False
+
+
 @app.route("/test", methods=["GET", "POST"])
 def test_endpoint():
     return (
@@ -520,7 +916,7 @@ def test_endpoint():
 
 @app.route("/webhook/gitlab", methods=["POST", "GET"])
 def gitlab_webhook():
-    print(f"Received request: Method={request.method}, Headers={request.headers}")
+    log.debug("Received request: Method=%s", request.method)
 
     if request.method == "GET":
         return (
@@ -529,14 +925,13 @@ def gitlab_webhook():
         )
 
     try:
-        data = request.json
-        # 데이터 일부 출력 (디버깅용)
-        data_preview = (
-            json.dumps(data)[:500] + "..."
-            if len(json.dumps(data)) > 500
-            else json.dumps(data)
-        )
+        # 데이터 일부 출력 (디버깅용, 파싱된 객체를 다시 직렬화하지 않고 원본 바이트 사용)
+        raw = request.get_data(cache=True)
+        data_preview = raw[:500].decode("utf-8", "replace")
+        if len(raw) > 500:
+            data_preview += "..."
         print(f"요청 데이터 미리보기: {data_preview}")
+        data = orjson.loads(raw)
     except Exception as e:
         print(f"요청 데이터 파싱 실패: {str(e)}")
         return jsonify({"status": "error", "message": "잘못된 JSON 형식"}), 400
@@ -546,12 +941,24 @@ def gitlab_webhook():
     object_kind = data.get("object_kind", "알 수 없음")
     print(f"이벤트 유형: {event_type}, Object Kind: {object_kind}")
 
+    # 재전송된 웹훅은 다시 처리하지 않음 (Gemini 중복 호출 방지)
+    if object_kind in ("merge_request", "note") and _is_duplicate_delivery(
+        request.headers.get("X-Gitlab-Event-UUID"), data
+    ):
+        print(f"이미 처리한 웹훅입니다. 건너뜁니다: object_kind={object_kind}")
+        return (
+            jsonify({"status": "duplicate", "message": "이미 접수된 요청입니다."}),
+            202,
+        )
+
     # 이벤트 유형에 따라 처리
     if object_kind == "merge_request":
         # MR 이벤트 처리
         print("MR 이벤트 감지됨 - 코드 리뷰 시작")
-        # 실제 처리는 별도 스레드에서 진행 (타임아웃 방지)
-        threading.Thread(target=process_mr_in_background, args=(data,)).start()
+        # 실제 처리는 스레드 풀에서 진행 (타임아웃 방지)
+        WEBHOOK_POOL.submit(process_mr_in_background, data).add_done_callback(
+            _log_task_exception
+        )
 
         return (
             jsonify(
@@ -566,8 +973,10 @@ def gitlab_webhook():
     elif object_kind == "note":
         # Note Hook 이벤트 처리
         print("Note Hook 이벤트 감지됨 - 댓글 처리")
-        # 실제 처리는 별도 스레드에서 진행
-        threading.Thread(target=process_note_in_background, args=(data,)).start()
+        # 실제 처리는 스레드 풀에서 진행
+        WEBHOOK_POOL.submit(process_note_in_background, data).add_done_callback(
+            _log_task_exception
+        )
 
         return (
             jsonify(
@@ -594,4 +1003,27 @@ def gitlab_webhook():
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=False)
+
+    # Flask 개발 서버 대신 gunicorn(gthread 워커)으로 실행
+    # 중복 웹훅 확인과 각종 캐시는 프로세스 안에만 있으므로 기본은 워커 1개 + 스레드
+    gunicorn_args = [
+        "gunicorn",
+        "mr:app",
+        "--chdir",
+        os.path.dirname(os.path.abspath(__file__)),
+        "-w",
+        os.getenv("WORKERS", "1"),
+        "--threads",
+        os.getenv("THREADS", "4"),
+        "--worker-class",
+        "gthread",
+        "--keep-alive",
+        "30",
+        "-b",
+        f"0.0.0.0:{port}",
+    ]
+    try:
+        os.execvp("gunicorn", gunicorn_args)
+    except FileNotFoundError:
+        print("gunicorn을 찾을 수 없어 Flask 개발 서버로 실행합니다.")
+        app.run(host="0.0.0.0", port=port, debug=False)